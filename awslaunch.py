@@ -1,17 +1,30 @@
 import argparse
 import configparser
+import functools
+import json
 import os
+import pickle
 import re
+import shutil
 import sys
+import tempfile
+import time
 import urllib.parse
 import webbrowser
-
-import boto3
-import ruyaml
-from pyfzf.pyfzf import FzfPrompt
+from dataclasses import dataclass
+from typing import Optional, Union
 
 CMD_END = ";"
 
+SWITCHROLE_URL = "https://signin.aws.amazon.com/switchrole"
+
+PROFILE_NAME_SANITIZE_TABLE = str.maketrans(dict.fromkeys("!@#$%^&*()[]{};:,./<>?|`~=_+ ", "-"))
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "awslaunch")
+CONFIG_CACHE_PATH = os.path.join(CACHE_DIR, "config.pickle")
+CONFIG_CACHE_VERSION = 2
+ACCOUNTS_CACHE_TTL = 24 * 60 * 60
+
 ACTIONS = {
     "assume": "Assume the role in the current shell",
     "browser": "Open browser to the switch role URL",
@@ -19,6 +32,19 @@ ACTIONS = {
     "url": "Print the Switch Role URL",
     "role": "Print the role ARN",
 }
+ACTION_KEYS = tuple(ACTIONS)
+FZF_ACTION_CHOICES = {f"{action}\t{help}": action for action, help in ACTIONS.items()}
+
+
+@dataclass(frozen=True)
+class Settings:
+    source_profile: str
+    organizations_profile: str
+    account_display_names: dict
+    roles_by_id: dict
+    default_roles: tuple
+    role_session_name: Optional[str]
+    duration_hours: Union[int, str]
 
 
 def cmd(*inputs):
@@ -33,33 +59,195 @@ def msg(*s):
     print(*s, file=sys.stderr)
 
 
-def generate_account_choices(account_display_names, organizations_client):
-    paginator = organizations_client.get_paginator("list_accounts")
-    accounts = [
+def resolve_settings(config, args):
+    source_profile = args.source_profile or config.get("source_profile", "default")
+    roles = {str(key): tuple(sorted(names)) for key, names in config.get("roles", {}).items()}
+    return Settings(
+        source_profile=source_profile,
+        organizations_profile=args.organizations_profile or config.get("organizations_profile", source_profile),
+        account_display_names={int(str(key)): name for key, name in config.get("account_display_names", {}).items()},
+        roles_by_id={int(key): names for key, names in roles.items() if key != "_"},
+        default_roles=roles.get("_", ("OrganizationAccountAccessRole",)),
+        role_session_name=config.get("role_session_name"),
+        duration_hours=args.duration_hours or config.get("duration_hours", 1),
+    )
+
+
+@functools.cache
+def aws_botocore_session(profile_name):
+    import botocore.session
+
+    return botocore.session.Session(profile=profile_name)
+
+
+@functools.cache
+def aws_session(profile_name):
+    import boto3
+
+    return boto3.Session(botocore_session=aws_botocore_session(profile_name))
+
+
+@functools.cache
+def aws_client_config():
+    from botocore.config import Config
+
+    return Config(
+        tcp_keepalive=True,
+        retries={"max_attempts": 3, "mode": "standard"},
+        connect_timeout=2,
+        read_timeout=10,
+        max_pool_connections=4,
+    )
+
+
+@functools.cache
+def aws_client(profile_name, service_name):
+    return aws_session(profile_name).client(service_name, config=aws_client_config())
+
+
+def accounts_cache_path(organizations_profile):
+    return os.path.join(CACHE_DIR, f"accounts-{organizations_profile}.json")
+
+
+def read_accounts_cache(cache_path, ttl=ACCOUNTS_CACHE_TTL):
+    try:
+        if time.time() - os.path.getmtime(cache_path) > ttl:
+            return None
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(cache_path, contents):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(contents)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        msg(f"unable to write cache '{cache_path}': {e}")
+
+
+def write_accounts_cache(cache_path, accounts):
+    write_cache(cache_path, json.dumps(accounts, default=str).encode())
+
+
+@functools.cache
+def yaml_config_loader():
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+
+    # PyYAML follows YAML 1.1, which reads leading-zero integers as octal (or as strings when they contain 8 or 9).
+    # Keep them as strings so account IDs like 012345678901 can be converted to decimal in resolve_settings.
+    class ConfigLoader(SafeLoader):
+        yaml_implicit_resolvers = {
+            first: list(resolvers) for first, resolvers in SafeLoader.yaml_implicit_resolvers.items()
+        }
+
+    ConfigLoader.yaml_implicit_resolvers["0"].insert(0, ("tag:yaml.org,2002:str", re.compile(r"^0[0-9]+$")))
+    return ConfigLoader
+
+
+def load_config(config_filename, cache_path=CONFIG_CACHE_PATH):
+    try:
+        stat = os.stat(config_filename)
+    except FileNotFoundError:
+        return {}
+    if not stat.st_size:
+        return {}
+    key = (CONFIG_CACHE_VERSION, config_filename, stat.st_mtime_ns, stat.st_size)
+    try:
+        with open(cache_path, "rb") as f:
+            cached_key, cached_config = pickle.load(f)
+        if cached_key == key:
+            return cached_config
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+    import yaml
+
+    with open(config_filename, "r") as f:
+        config = yaml.load(f, Loader=yaml_config_loader()) or {}
+    write_cache(cache_path, pickle.dumps((key, config)))
+    return config
+
+
+def list_accounts(organizations_profile, refresh=False):
+    cache_path = accounts_cache_path(organizations_profile)
+    accounts = None if refresh else read_accounts_cache(cache_path)
+    if accounts is None:
+        paginator = aws_client(organizations_profile, "organizations").get_paginator("list_accounts")
+        pages = paginator.paginate(PaginationConfig={"PageSize": 20})
+        accounts = [account for page in pages for account in page["Accounts"]]
+        write_accounts_cache(cache_path, accounts)
+    return accounts
+
+
+def generate_account_choices(account_display_names, organizations_profile, refresh=False):
+    accounts = (
         account | {"DisplayName": account_display_names.get(int(account["Id"]), account["Name"])}
-        for page in paginator.paginate() for account in page["Accounts"]
-    ]
-    return dict([(f'{account["DisplayName"]} ({account["Id"]})', account) for account in accounts])
+        for account in list_accounts(organizations_profile, refresh=refresh)
+    )
+    return {f'{account["DisplayName"]} ({account["Id"]})': account for account in accounts}
+
+
+def generate_pinned_account(account_display_names, account_id):
+    if not account_id or not account_id.isdigit() or int(account_id) not in account_display_names:
+        return None
+    display_name = account_display_names[int(account_id)]
+    return {"Id": account_id, "Name": display_name, "DisplayName": display_name}
 
 
 def generate_role_arn(account_id, role_name):
     return f"arn:aws:iam::{account_id}:role/{role_name}"
 
 
+def encode_display_name(display_name):
+    return urllib.parse.quote_from_bytes(display_name.encode(), safe=b"").replace("%20", "+")
+
+
 def generate_url(role_name, account_id, display_name):
-    encoded_display_name = urllib.parse.quote_plus(display_name)
-    return f"https://signin.aws.amazon.com/switchrole?roleName={role_name}&account={account_id}&displayName={encoded_display_name}"
+    encoded_display_name = encode_display_name(display_name)
+    return f"{SWITCHROLE_URL}?roleName={role_name}&account={account_id}&displayName={encoded_display_name}"
 
 
-def generate_session_name(sts_client, config, default="awslaunch"):
-    session_name = config.get("role_session_name")
-    if session_name:
-        return session_name
+def prefetch_caller_identity(profile_name):
+    from botocore.exceptions import BotoCoreError
+
+    # Credentials are resolved here on the main thread so any prompt (e.g. for an MFA code) never runs
+    # concurrently with fzf or the Organizations listing. MFA profiles are left to prompt only when needed.
     try:
-        caller_arn = sts_client.get_caller_identity()["Arn"]
-        return re.findall(r".+/(.+)", caller_arn)[0]
-    except:
+        if "mfa_serial" in aws_botocore_session(profile_name).get_scoped_config():
+            return None
+        credentials = aws_session(profile_name).get_credentials()
+        if credentials is None:
+            return None
+        credentials.get_frozen_credentials()
+    except BotoCoreError:
+        return None
+    from concurrent.futures import ThreadPoolExecutor
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(aws_client(profile_name, "sts").get_caller_identity)
+    executor.shutdown(wait=False)
+    return future
+
+
+def generate_session_name(sts_client, default="awslaunch", caller_identity_future=None):
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    try:
+        if caller_identity_future is not None:
+            caller_arn = caller_identity_future.result()["Arn"]
+        else:
+            caller_arn = sts_client.get_caller_identity()["Arn"]
+    except (BotoCoreError, ClientError):
         return default
+    prefix, _, name = caller_arn.rpartition("/")
+    return name if prefix and name else default
 
 
 def generate_session_credentials_commands(sts_client, role_arn, session_name, duration_hours=1, external_id=""):
@@ -88,37 +276,46 @@ def generate_unset_credentials_commands():
 
 
 def generate_save_profile_name(account_display_name, role_name):
-    return re.sub(r"[!@#$%^&\*\(\)\[\]\{\};:\,\./<>\?\|`~=_+ ]", "-", f"{account_display_name}-{role_name}".lower())
+    return f"{account_display_name}-{role_name}".lower().translate(PROFILE_NAME_SANITIZE_TABLE)
 
 
 def choose_account(account_choices, account_id=None):
     if account_id:
-        return [account for account in account_choices.values() if account["Id"] == account_id][0]
+        return next((account for account in account_choices.values() if account["Id"] == account_id), None)
+    from pyfzf.pyfzf import FzfPrompt
+
     fzf = FzfPrompt()
-    choice = fzf.prompt(sorted(account_choices.keys()))
+    choice = fzf.prompt(sorted(account_choices), "--tiebreak=begin,length")
     return account_choices[choice[0]]
 
 
-def choose_role_name(role_map, account_id, args):
+def choose_role_name(roles_by_id, default_roles, account_id, args):
     if args.role_name:
         return args.role_name
-    default_roles = role_map.get("_", ["OrganizationAccountAccessRole"])
-    roles = role_map.get(int(account_id), default_roles)
+    roles = roles_by_id.get(int(account_id), default_roles)
     if len(roles) == 1:
         return roles[0]
+    from pyfzf.pyfzf import FzfPrompt
+
     fzf = FzfPrompt()
-    choice = fzf.prompt(sorted(roles))
+    choice = fzf.prompt(roles, "--tiebreak=begin,length")
     return choice[0]
 
 
+def get_passed_actions(args):
+    passed = vars(args)
+    return [action for action in ACTION_KEYS if passed.get(action)]
+
+
 def choose_actions(args):
-    passed_actions = [action for action in ACTIONS.keys() if getattr(args, action)]
+    passed_actions = get_passed_actions(args)
     if passed_actions:
         return passed_actions
+    from pyfzf.pyfzf import FzfPrompt
+
     fzf = FzfPrompt()
-    choices = dict([(f"{action}\t{help}", action) for action, help in ACTIONS.items()])
-    chosen = fzf.prompt(choices, "--multi")
-    return [choices[choice] for choice in chosen]
+    chosen = fzf.prompt(FZF_ACTION_CHOICES, "--multi")
+    return [FZF_ACTION_CHOICES[choice] for choice in chosen]
 
 
 def choose_save_profile_name(args, default="default"):
@@ -130,16 +327,33 @@ def choose_save_profile_name(args, default="default"):
 
 def save_profile(source_profile, role_arn, session_name, profile_name):
     aws_config_path = os.path.join(os.path.expanduser("~"), ".aws", "config")
-    aws_config = configparser.ConfigParser()
+    aws_config = configparser.RawConfigParser(delimiters=("=",), strict=False)
     aws_config.read(aws_config_path)
     section = f"profile {profile_name}"
-    aws_config.add_section(section)
+    aws_config.remove_section(section)
     aws_config[section] = aws_config[f"profile {source_profile}"]
     aws_config[section]["source_profile"] = source_profile
     aws_config[section]["role_session_name"] = session_name
     aws_config[section]["role_arn"] = role_arn
-    with open(aws_config_path, "w") as f:
-        aws_config.write(f)
+    # Write through symlinks (e.g. a dotfile manager) instead of replacing the link itself.
+    target_path = os.path.realpath(aws_config_path)
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(target_path), delete=False) as f:
+        try:
+            aws_config.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    try:
+        if os.path.exists(target_path):
+            shutil.copymode(target_path, f.name)
+            shutil.copy2(target_path, f"{target_path}.bak")
+        os.replace(f.name, target_path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
 
 
 def main(config, args):
@@ -147,22 +361,42 @@ def main(config, args):
         [cmd(c) for c in generate_unset_credentials_commands()]
         msg("session environment variables cleared.")
         return 0
-    source_profile = args.source_profile or config.get("source_profile", "default")
-    source_session = boto3.Session(profile_name=source_profile)
-    organizations_profile = args.organizations_profile or config.get("organizations_profile", source_profile)
-    organizations_session = boto3.Session(profile_name=organizations_profile)
-    organizations_client = organizations_session.client("organizations")
-    sts_client = source_session.client("sts")
-
-    account_choices = generate_account_choices(
-        account_display_names=config.get("account_display_names", {}), organizations_client=organizations_client
-    )
-    account = choose_account(account_choices=account_choices, account_id=args.account_id)
+    settings = resolve_settings(config=config, args=args)
+    passed_actions = get_passed_actions(args)
+    caller_identity_future = None
+    if not settings.role_session_name and (
+        not passed_actions or "assume" in passed_actions or "save" in passed_actions
+    ):
+        caller_identity_future = prefetch_caller_identity(settings.source_profile)
+
+    account = generate_pinned_account(account_display_names=settings.account_display_names, account_id=args.account_id)
+    if account is None:
+        account_choices = generate_account_choices(
+            account_display_names=settings.account_display_names,
+            organizations_profile=settings.organizations_profile,
+            refresh=args.refresh_accounts,
+        )
+        account = choose_account(
+            account_choices=account_choices,
+            account_id=args.account_id,
+        )
+        if account is None and not args.refresh_accounts:
+            # The cached account list may predate the account, so fetch it again once.
+            account_choices = generate_account_choices(
+                account_display_names=settings.account_display_names,
+                organizations_profile=settings.organizations_profile,
+                refresh=True,
+            )
+            account = choose_account(account_choices=account_choices, account_id=args.account_id)
+    if account is None:
+        msg(f"account '{args.account_id}' was not found in AWS Organizations")
+        return 1
     account_id = account["Id"]
     account_display_name = account["DisplayName"]
     role_name = choose_role_name(
         account_id=account_id,
-        role_map=config.get("roles", {}),
+        roles_by_id=settings.roles_by_id,
+        default_roles=settings.default_roles,
         args=args,
     )
     role_arn = generate_role_arn(account_id=account_id, role_name=role_name)
@@ -172,10 +406,19 @@ def main(config, args):
     if not actions:
         raise Exception(f"Oh dang this should never happen, action is {actions}")
     if "assume" in actions:
-        session_name = generate_session_name(sts_client=sts_client, config=config)
-        duration_hours = int(args.duration_hours or config.get("duration_hours", 1))
+        try:
+            duration_hours = int(settings.duration_hours)
+        except (TypeError, ValueError):
+            msg(f"duration hours must be a whole number, got '{settings.duration_hours}'")
+            return 1
+    if "assume" in actions or "save" in actions:
+        session_name = settings.role_session_name or generate_session_name(
+            sts_client=aws_client(settings.source_profile, "sts"),
+            caller_identity_future=caller_identity_future,
+        )
+    if "assume" in actions:
         session_credentials_commands = generate_session_credentials_commands(
-            sts_client=sts_client,
+            sts_client=aws_client(settings.source_profile, "sts"),
             role_arn=role_arn,
             session_name=session_name,
             duration_hours=duration_hours,
@@ -187,9 +430,8 @@ def main(config, args):
         msg(f"opening browser to '{url}'")
         webbrowser.open(url)
     if "save" in actions:
-        session_name = generate_session_name(sts_client=sts_client, config=config)
         msg("saving role assume to an AWS profile")
-        msg(f"Source profile: {source_profile}")
+        msg(f"Source profile: {settings.source_profile}")
         msg(f"Account name: {account_display_name}")
         msg(f"Role ARN: {role_arn}")
         msg(f"Role Session Name: {session_name}")
@@ -199,7 +441,10 @@ def main(config, args):
         save_profile_name = choose_save_profile_name(args=args, default=default_save_profile_name)
         msg(f"Profile Name: {save_profile_name}")
         save_profile(
-            source_profile=source_profile, role_arn=role_arn, session_name=session_name, profile_name=save_profile_name
+            source_profile=settings.source_profile,
+            role_arn=role_arn,
+            session_name=session_name,
+            profile_name=save_profile_name,
         )
         msg(f"Profile saved. Use `--profile {save_profile_name}` or `AWS_PROFILE={save_profile_name}` to use it")
     if "url" in actions:
@@ -210,7 +455,7 @@ def main(config, args):
     return 0
 
 
-if __name__ == "__main__":
+def build_parser():
     parser = argparse.ArgumentParser(prog="awslaunch", add_help=False)
     parser.add_argument("--help", "-h", action="store_true", help="show this help message and exit")
     for action, help in ACTIONS.items():
@@ -227,6 +472,11 @@ if __name__ == "__main__":
         default="",
         help="Use external ID when assuming role (doesn't work in the browser)",
     )
+    parser.add_argument(
+        "--refresh-accounts",
+        action="store_true",
+        help="Ignore the cached AWS organizations account list and fetch it again",
+    )
     parser.add_argument("--role-name", required=False, default=None, help="Pass the role name explicitly")
     parser.add_argument("--account-id", required=False, default=None, help="Pass the account ID explicitly")
     parser.add_argument("--duration-hours", required=False, default=None, help="Session duration in hours")
@@ -242,14 +492,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "--save-profile-name", required=False, default=None, help="Profile name to save when using --save"
     )
+    return parser
 
+
+if __name__ == "__main__":
+    parser = build_parser()
     args = parser.parse_args()
     if args.help:
         parser.print_help(sys.stderr)
         sys.exit(0)
     config_filename = os.path.join(os.path.expanduser("~"), ".awslaunch.yaml")
-    config = {}
-    if os.path.exists(config_filename):
-        with open(config_filename, "r") as f:
-            config = ruyaml.safe_load(f)
+    config = load_config(config_filename)
     sys.exit(main(config=config, args=args))